@@ -22,7 +22,6 @@
 
 from collections import deque
 from datetime import datetime
-import time
 import threading
 
 import requests
@@ -100,6 +99,7 @@ class IOUHTTPReactor(object):
     _worker = None
     _should_stop = None
     _did_stop = None
+    _task_available = None
     _priorities = (PRIORITY_HIGH, PRIORITY_BACKGROUND, PRIORITY_NORMAL)
     _method_dispatch = None
 
@@ -111,6 +111,7 @@ class IOUHTTPReactor(object):
         self.header = {}
         self._should_stop = threading.Event()
         self._did_stop = threading.Event()
+        self._task_available = threading.Event()
 
         # pre-build the session object and method dispatch
         self._http_session = requests.Session()
@@ -145,6 +146,7 @@ class IOUHTTPReactor(object):
         to wait for the reactor to stop before timing out
         '''
         self._should_stop.set()
+        self._task_available.set()
         if blocking:
             self._did_stop.wait(timeout)
     
@@ -168,6 +170,7 @@ class IOUHTTPReactor(object):
         task.promise = IOU(promise_name)
         priority = task.priority
         self._queues[priority].append(task)
+        self._task_available.set()
 
         return task.promise
 
@@ -241,11 +244,12 @@ class IOUHTTPReactor(object):
         This is generally run on a seperate thread.
         '''
         while not self._should_stop.is_set():
+            # clear before looking for a task so a submission that lands
+            # after the queues are checked still wakes the loop
+            self._task_available.clear()
             task = self._execute_next_task()
             if task is None:
-                # TODO: I may attempt to use threading.Event.wait() in
-                #       the future instead
-                time.sleep(0.1)
+                self._task_available.wait(RUNLOOP_WAIT_DELAY)
         
         self._did_stop.set()
 
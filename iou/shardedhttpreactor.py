@@ -0,0 +1,574 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2014 PIX System, LLC. and Eric Reinecke
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from bisect import bisect
+from collections import deque
+from datetime import datetime
+from hashlib import md5
+from urlparse import urlparse
+import cPickle as pickle
+import copy
+import itertools
+import multiprocessing
+import Queue
+import threading
+
+from iou import IOU
+from httpreactor import IOUHTTPReactor, IOUHTTPReactorTask
+from httpreactor import IOUHTTPTransportError, name_for_method
+
+# Number of points each shard gets on the hash ring, more points gives a more
+# even spread of hosts across the shards
+RING_REPLICAS = 256
+
+# Defines the number of seconds the collector waits for a result before
+# checking whether any shard processes have died
+SHARD_POLL_INTERVAL = 0.5
+
+# Messages sent from the parent to the shard processes
+_MSG_TASK = 1
+_MSG_HEADERS = 2
+_MSG_STOP = 3
+
+# Messages sent from the shard processes back to the parent
+_MSG_FULFILLED = 4
+_MSG_REJECTED = 5
+_MSG_STOPPED = 6
+
+def _ring_hash(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return long(md5(key).hexdigest()[:16], 16)
+
+def host_for_url(url):
+    '''
+    returns the host portion of the url, used as the shard key for a task
+    '''
+    return urlparse(url).netloc.lower()
+
+def _error_message(e):
+    try:
+        return str(e)
+    except Exception:
+        return repr(e)
+
+
+class _HashRing(object):
+    '''
+    Consistent hash ring mapping shard keys to shard indexes.
+    '''
+    _hashes = None
+    _shards = None
+
+    def __init__(self, shard_count, replicas=RING_REPLICAS):
+        points = sorted((_ring_hash("%d-%d"%(shard, replica)), shard)
+                for shard in range(shard_count)
+                for replica in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._shards = [point[1] for point in points]
+
+    def shard_for_key(self, key):
+        index = bisect(self._hashes, _ring_hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+def _pack_task(task):
+    '''
+    Pickles a task to be sent to a shard process, leaving the promise behind
+    since it only has meaning in the parent
+    '''
+    shard_task = copy.copy(task)
+    shard_task.promise = None
+    return pickle.dumps(shard_task, -1)
+
+def _pack_result(kind, task_id, task, response=None, message=None,
+        status_code=None, underlying_exception=None):
+    '''
+    Builds the (kind, task_id, data) message for a task result in the shard
+    process, data being the pickled times and payload. kind and task_id are
+    left outside the pickle so the parent can settle the IOU even if data
+    won't unpickle there.
+    The payload always has the same keys. If it won't pickle, the response
+    and underlying exception are dropped (rejecting the task if it was
+    fulfilled) so the parent IOU still gets settled.
+    '''
+    # IOUHTTPReactor rejects before stamping time_completed
+    times = (task.time_run, task.time_completed or datetime.utcnow())
+    payload = dict(response=response, message=message,
+            status_code=status_code,
+            underlying_exception=underlying_exception)
+    try:
+        return (kind, task_id, pickle.dumps((times, payload), -1))
+    except Exception, e:
+        if kind == _MSG_FULFILLED:
+            kind = _MSG_REJECTED
+            payload["message"] = "Unable to pickle response for %s: %s"%(
+                    task.request_url, _error_message(e))
+        payload["response"] = None
+        payload["underlying_exception"] = None
+
+    return (kind, task_id, pickle.dumps((times, payload), -1))
+
+def _shard_main(index, task_queue, result_queue, headers):
+    '''
+    Entry point for a shard process. Runs a regular IOUHTTPReactor and relays
+    the settled task IOUs back to the parent over result_queue.
+    '''
+    reactor = IOUHTTPReactor()
+    reactor.update_default_headers(headers)
+    reactor.start()
+
+    def relay(task_id, task):
+        def fulfilled(response):
+            result_queue.put(_pack_result(_MSG_FULFILLED, task_id, task,
+                response=response))
+        def rejected(e):
+            response = getattr(e, "response", None)
+            result_queue.put(_pack_result(_MSG_REJECTED, task_id, task,
+                response=response, message=_error_message(e),
+                status_code=getattr(response, "status_code", None),
+                underlying_exception=getattr(e, "underlying_exception",
+                    None)))
+        return fulfilled, rejected
+
+    while True:
+        message = task_queue.get()
+        kind = message[0]
+        if kind == _MSG_TASK:
+            task_id, data = message[1:]
+            try:
+                task = pickle.loads(data)
+            except Exception, e:
+                message = "Unable to unpickle task: %s"%_error_message(e)
+                result_queue.put(_pack_result(_MSG_REJECTED, task_id,
+                    IOUHTTPReactorTask(), message=message))
+                continue
+            reactor.submit_task(task).add_handlers(*relay(task_id, task))
+        elif kind == _MSG_HEADERS:
+            reactor.update_default_headers(message[1])
+        elif kind == _MSG_STOP:
+            break
+
+    # Anything still queued in the reactor is dropped, the parent rejects
+    # those tasks when it sees the shard has stopped
+    reactor.stop(blocking=True)
+    result_queue.put((_MSG_STOPPED, index, None))
+
+
+class IOUShardedHTTPReactor(object):
+    '''
+    Replacement for IOUHTTPReactor that spreads tasks across a pool of worker
+    processes, each running its own IOUHTTPReactor. Tasks are consistently
+    hashed by host so connections keep getting reused within a shard. IOUs
+    are settled in the parent process from a collector thread.
+
+    Tasks are pickled (without their promise) to get them to the shards, so
+    task subclasses must be picklable and importable in the shard processes.
+    Responses are pickled back to the parent, so the content of every
+    response is read in full by the shard.
+
+    Tasks submitted while the reactor is stopped are held until it is
+    started. Tasks a shard hasn't completed when the reactor is stopped, or
+    when the shard process dies, are rejected with an IOUHTTPTransportError.
+    A shard process that dies is replaced so its hosts keep being served.
+    '''
+    shard_count = None
+
+    _ring = None
+    _headers = None
+    _shards = None
+    _backlog = None
+    _collector = None
+    _pending = None
+    _lock = None
+    _task_ids = None
+    _did_stop = None
+
+    def __init__(self, shard_count=None):
+        if shard_count is None:
+            shard_count = multiprocessing.cpu_count()
+        self.shard_count = shard_count
+        self._ring = _HashRing(shard_count)
+        self._headers = {}
+        self._shards = []
+        self._backlog = deque()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._task_ids = itertools.count()
+        self._did_stop = threading.Event()
+        self._did_stop.set()
+
+    @property
+    def is_running(self):
+        '''Returns whether the shard processes have been started
+        '''
+        return bool(self._shards)
+
+    def start(self):
+        '''
+        starts up the shard processes and the collector thread, then hands
+        off any tasks submitted while the reactor was stopped.
+        If a previous stop is still in progress, this waits for it to finish.
+        '''
+        if self.is_running:
+            return
+        self._did_stop.wait()
+
+        with self._lock:
+            if self.is_running:
+                return
+            self._did_stop.clear()
+            result_queue = multiprocessing.Queue()
+            shards = [self._spawn_shard(index, result_queue)
+                    for index in range(self.shard_count)]
+            self._shards = shards
+
+            self._collector = threading.Thread(target=self._collect_results,
+                    args=(result_queue, shards),
+                    name="IOUShardedHTTPReactor collector thread")
+            self._collector.daemon = True
+            self._collector.start()
+
+            failed = []
+            while self._backlog:
+                failed.extend(self._dispatch(*self._backlog.popleft()))
+
+        for task, message in failed:
+            self._reject_task(task, message)
+
+    def _spawn_shard(self, index, result_queue):
+        '''
+        Starts the process for the shard at index
+        returns a (process, task_queue) pair
+        '''
+        task_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_shard_main,
+                args=(index, task_queue, result_queue, self._headers),
+                name="IOUShardedHTTPReactor shard %d"%index)
+        process.daemon = True
+        process.start()
+        return (process, task_queue)
+
+    def stop(self, blocking=False, timeout=None):
+        '''
+        Shuts the shard processes down
+        will block if blocking is True
+        if blocking is True, timeout can be set to a number of seconds
+        to wait for the reactor to stop before timing out
+        '''
+        with self._lock:
+            shards, self._shards = self._shards, []
+            for process, task_queue in shards:
+                task_queue.put((_MSG_STOP,))
+        if blocking:
+            self._did_stop.wait(timeout)
+
+    def update_default_headers(self, headers):
+        '''
+        Updates the standard headers on the session of every shard with the
+        provided header dictionary.
+        Setting the value of a key to None removes that key from the headers
+        entirely.
+        '''
+        with self._lock:
+            self._headers.update(headers)
+            for process, task_queue in self._shards:
+                task_queue.put((_MSG_HEADERS, headers))
+
+    def submit_task(self, task):
+        '''
+        takes a pix reactor task and hands it off to the shard for its host
+        returns a promise to be fulfilled on completion of task
+        '''
+        task.time_scheduled = datetime.utcnow()
+        promise_name = (name_for_method(task.request_method)+" "+
+                task.request_url)
+        task.promise = IOU(promise_name)
+
+        try:
+            data = _pack_task(task)
+        except Exception, e:
+            self._reject_task(task, "Unable to pickle task %s: %s"%(
+                promise_name, _error_message(e)), underlying_exception=e)
+            return task.promise
+
+        shard = self._ring.shard_for_key(host_for_url(task.request_url))
+        task_id = next(self._task_ids)
+        with self._lock:
+            self._pending[task_id] = (shard, task)
+            if self.is_running:
+                failed = self._dispatch(task_id, shard, data)
+            else:
+                self._backlog.append((task_id, shard, data))
+                failed = []
+
+        for failed_task, message in failed:
+            self._reject_task(failed_task, message)
+
+        return task.promise
+
+    def _dispatch(self, task_id, shard, data):
+        '''
+        Sends a task to its shard. Must be called with _lock held.
+        returns a list of (task, message) pairs to be rejected once the lock
+        is released, which holds the task if its shard process has died.
+        '''
+        process, task_queue = self._shards[shard]
+        if not process.is_alive():
+            shard, task = self._pending.pop(task_id)
+            return [(task, "%s exited with code %s"%(process.name,
+                process.exitcode))]
+        task_queue.put((_MSG_TASK, task_id, data))
+        return []
+
+    def _reject_task(self, task, message, status_code=None, response=None,
+            underlying_exception=None):
+        e = IOUHTTPTransportError(message)
+        e.status_code = status_code
+        e.response = response
+        e.underlying_exception = underlying_exception
+        e.task = task
+        if task.time_completed is None:
+            task.time_completed = datetime.utcnow()
+        task.promise.reject(e)
+
+    def _reject_shard_tasks(self, index, message):
+        '''
+        Rejects every outstanding task sent to the shard at index
+        '''
+        with self._lock:
+            task_ids = [task_id for task_id, (shard, task) in
+                    self._pending.iteritems() if shard == index]
+            tasks = [self._pending.pop(task_id)[1] for task_id in task_ids]
+        for task in tasks:
+            self._reject_task(task, message)
+
+    def _settle_task(self, kind, task_id, times, payload):
+        '''
+        Settles the IOU for the task with task_id using a shard's result
+        '''
+        with self._lock:
+            shard, task = self._pending.pop(task_id, (None, None))
+        if task is None:
+            return
+
+        try:
+            task.time_run, task.time_completed = times
+            if kind == _MSG_FULFILLED:
+                task.promise.fulfill(payload["response"])
+            else:
+                self._reject_task(task, payload["message"],
+                        payload["status_code"], payload["response"],
+                        payload["underlying_exception"])
+        except Exception, e:
+            if not task.promise.is_settled:
+                self._reject_task(task, "Unable to settle %s: %s"%(
+                    task.promise.name, _error_message(e)),
+                    underlying_exception=e)
+
+    def _handle_result(self, running, message):
+        kind, task_id, data = message
+        if kind == _MSG_STOPPED:
+            # stopped messages carry the shard index in place of a task id
+            running.discard(task_id)
+            self._reject_shard_tasks(task_id,
+                    "IOUShardedHTTPReactor stopped before the task completed")
+            return
+
+        try:
+            times, payload = pickle.loads(data)
+        except Exception, e:
+            kind = _MSG_REJECTED
+            times = (None, None)
+            payload = dict(response=None, status_code=None,
+                    message="Unable to unpickle result: %s"%(
+                        _error_message(e)),
+                    underlying_exception=e)
+        self._settle_task(kind, task_id, times, payload)
+
+    def _replace_dead_shard(self, index, result_queue, shards, running):
+        '''
+        Rejects the outstanding tasks of the dead shard at index and, unless
+        the reactor has been stopped, starts a new process in its place.
+        '''
+        process, task_queue = shards[index]
+        message = "%s exited with code %s"%(process.name, process.exitcode)
+        with self._lock:
+            task_ids = [task_id for task_id, (shard, task) in
+                    self._pending.iteritems() if shard == index]
+            tasks = [self._pending.pop(task_id)[1] for task_id in task_ids]
+            if self._shards is shards:
+                shards[index] = self._spawn_shard(index, result_queue)
+            else:
+                running.discard(index)
+
+        # nothing will read what is left in the old queue
+        task_queue.cancel_join_thread()
+        task_queue.close()
+        process.join()
+
+        for task in tasks:
+            self._reject_task(task, message)
+
+    def _collect_results(self, result_queue, shards):
+        '''
+        Settles task IOUs as results come back from the shards until every
+        shard has stopped, replacing any shard processes that die, then
+        cleans up the shard processes.
+        This is generally run on a seperate thread.
+        '''
+        running = set(range(len(shards)))
+        try:
+            while running:
+                try:
+                    message = result_queue.get(timeout=SHARD_POLL_INTERVAL)
+                except Queue.Empty:
+                    pass
+                else:
+                    self._handle_result(running, message)
+                    continue
+
+                dead = [index for index in running
+                        if not shards[index][0].is_alive()]
+                if not dead:
+                    continue
+
+                # A shard flushes its results before exiting, read anything
+                # left before giving up on its outstanding tasks
+                while True:
+                    try:
+                        message = result_queue.get(block=False)
+                    except Queue.Empty:
+                        break
+                    self._handle_result(running, message)
+
+                for index in dead:
+                    if index in running:
+                        self._replace_dead_shard(index, result_queue, shards,
+                                running)
+        finally:
+            # shards are only left running if collecting failed part way
+            for index in running:
+                shards[index][0].terminate()
+                self._reject_shard_tasks(index,
+                        "IOUShardedHTTPReactor stopped collecting results")
+            for process, task_queue in shards:
+                process.join()
+                task_queue.close()
+            result_queue.close()
+            self._did_stop.set()
+
+
+if __name__ == "__main__":
+    # Throughput check against local stub servers, each in its own process so
+    # they don't share a GIL with the reactor. Every response is a chunk of
+    # JSON that gets parsed in a response hook, standing in for the CPU bound
+    # response handling that keeps a single reactor process busy.
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    import json
+    import time
+
+    CORES = multiprocessing.cpu_count()
+    SERVER_COUNT = max(2, CORES)
+    # Tasks are routed by host, so the requests are spread over enough hosts
+    # (ports here) that every shard gets close to an even share of them
+    PORTS_PER_SERVER = 64 * CORES // SERVER_COUNT
+    HOST_COUNT = PORTS_PER_SERVER * SERVER_COUNT
+    REQUEST_COUNT = 8 * HOST_COUNT
+    BODY = json.dumps([dict(id=i, name="item %d"%i, tags=["a", "b", "c"])
+        for i in range(2000)])
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+        def log_message(self, *args):
+            pass
+
+    class StubServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    def serve_stubs(port_pipe):
+        servers = [StubServer(("127.0.0.1", 0), StubHandler)
+                for i in range(PORTS_PER_SERVER)]
+        port_pipe.send([server.server_address[1] for server in servers])
+        for server in servers[1:]:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        servers[0].serve_forever()
+
+    def parse_response(response, *args, **kwargs):
+        response.parsed = json.loads(response.content)
+        return response
+
+    class ParsingTask(IOUHTTPReactorTask):
+        def _request_kwargs(self):
+            kwargs = super(ParsingTask, self)._request_kwargs()
+            kwargs["hooks"] = dict(response=parse_response)
+            return kwargs
+
+    urls = []
+    for i in range(SERVER_COUNT):
+        parent_pipe, child_pipe = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve_stubs,
+                args=(child_pipe,))
+        server.daemon = True
+        server.start()
+        urls.extend("http://127.0.0.1:%d/"%port
+                for port in parent_pipe.recv())
+
+    def run(reactor, label):
+        reactor.start()
+        start = time.time()
+        promises = [reactor.submit_task(ParsingTask(urls[i % len(urls)]))
+                for i in range(REQUEST_COUNT)]
+        for p in promises:
+            p.wait()
+        rate = REQUEST_COUNT / (time.time() - start)
+        reactor.stop(blocking=True)
+        print "%s: %.1f requests/sec"%(label, rate)
+
+    def busiest_share(shard_count):
+        '''
+        returns the fraction of the requests the busiest shard gets, which
+        caps the speedup at its inverse
+        '''
+        ring = _HashRing(shard_count)
+        counts = [0] * shard_count
+        for i in range(REQUEST_COUNT):
+            counts[ring.shard_for_key(host_for_url(urls[i % HOST_COUNT]))] += 1
+        return max(counts) / float(REQUEST_COUNT)
+
+    print "%d core(s), %d stub servers"%(CORES, SERVER_COUNT)
+    print "%d hosts, %d requests"%(HOST_COUNT, REQUEST_COUNT)
+    run(IOUHTTPReactor(), "IOUHTTPReactor")
+    for shard_count in range(1, CORES + 1):
+        share = busiest_share(shard_count)
+        run(IOUShardedHTTPReactor(shard_count),
+                "IOUShardedHTTPReactor, %d shard(s), speedup cap %.2fx"%(
+                    shard_count, 1 / share))
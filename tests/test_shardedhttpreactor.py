@@ -0,0 +1,282 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import cPickle as pickle
+import os
+import threading
+import time
+import unittest
+
+import requests
+
+from iou.httpreactor import IOUHTTPReactorTask, IOUHTTPTransportError
+from iou import shardedhttpreactor
+from iou.shardedhttpreactor import IOUShardedHTTPReactor, _HashRing
+
+# Seconds to wait on an IOU before failing the test instead of hanging
+WAIT_TIMEOUT = 10
+
+PAYLOAD_KEYS = set(["response", "message", "status_code",
+    "underlying_exception"])
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    '''
+    Responds with the value of the X-Test header the request was made with
+    '''
+    protocol_version = "HTTP/1.1"
+    def do_GET(self):
+        body = self.headers.get("X-Test", "")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):
+        pass
+
+
+class EchoServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TwoArgError(Exception):
+    '''
+    Pickles fine but can't be unpickled, since only the message is kept in args
+    '''
+    def __init__(self, first, second):
+        super(TwoArgError, self).__init__("%s %s"%(first, second))
+
+
+class RaisingTask(IOUHTTPReactorTask):
+    def _request_kwargs(self):
+        raise TwoArgError("a", "b")
+
+
+class SlowTask(IOUHTTPReactorTask):
+    def _request_kwargs(self):
+        time.sleep(0.3)
+        return super(SlowTask, self)._request_kwargs()
+
+
+class ExitTask(IOUHTTPReactorTask):
+    '''
+    Kills the shard process that runs it
+    '''
+    def _request_kwargs(self):
+        os._exit(1)
+
+
+def wait(promise):
+    promise._settled_event.wait(WAIT_TIMEOUT)
+    if not promise.is_settled:
+        raise AssertionError("%s was never settled"%promise)
+    return promise.value
+
+
+class HashRingTest(unittest.TestCase):
+    def test_stable(self):
+        keys = ["host%d.example.com"%i for i in range(100)]
+        first = [_HashRing(4).shard_for_key(key) for key in keys]
+        second = [_HashRing(4).shard_for_key(key) for key in keys]
+        self.assertEqual(first, second)
+
+    def test_spread(self):
+        ring = _HashRing(4)
+        counts = [0] * 4
+        for i in range(1000):
+            counts[ring.shard_for_key("host%d.example.com"%i)] += 1
+        for count in counts:
+            self.assertTrue(150 < count < 350, counts)
+
+    def test_adding_shard_moves_few_keys(self):
+        keys = ["host%d.example.com"%i for i in range(1000)]
+        before, after = _HashRing(4), _HashRing(5)
+        moved = sum(1 for key in keys
+                if before.shard_for_key(key) != after.shard_for_key(key))
+        self.assertTrue(moved < 350, moved)
+
+    def test_unicode_host(self):
+        host = shardedhttpreactor.host_for_url(u"http://b\xfccher.de/")
+        self.assertEqual(host, u"b\xfccher.de")
+        self.assertTrue(_HashRing(4).shard_for_key(host) in range(4))
+
+
+class SettleTest(unittest.TestCase):
+    def setUp(self):
+        self.reactor = IOUShardedHTTPReactor(1)
+
+    def pending_task(self, task_id):
+        task = IOUHTTPReactorTask("http://example.com/")
+        task.promise = shardedhttpreactor.IOU()
+        self.reactor._pending[task_id] = (0, task)
+        return task
+
+    def settle(self, packed):
+        self.reactor._handle_result(set(), packed)
+
+    def payload(self, packed):
+        return pickle.loads(packed[2])[1]
+
+    def test_fulfilled(self):
+        task = self.pending_task(1)
+        packed = shardedhttpreactor._pack_result(
+                shardedhttpreactor._MSG_FULFILLED, 1, task, response="body")
+        self.assertEqual(set(self.payload(packed)), PAYLOAD_KEYS)
+        self.settle(packed)
+        self.assertTrue(task.promise.is_fulfilled)
+        self.assertEqual(task.promise.value, "body")
+        self.assertFalse(self.reactor._pending)
+
+    def test_rejected(self):
+        task = self.pending_task(1)
+        self.settle(shardedhttpreactor._pack_result(
+                shardedhttpreactor._MSG_REJECTED, 1, task, response="body",
+                message="failed", status_code=500,
+                underlying_exception=ValueError("bad")))
+        e = task.promise.value
+        self.assertTrue(task.promise.is_rejected)
+        self.assertTrue(isinstance(e, IOUHTTPTransportError))
+        self.assertEqual(str(e), "failed")
+        self.assertEqual(e.status_code, 500)
+        self.assertEqual(e.response, "body")
+        self.assertTrue(isinstance(e.underlying_exception, ValueError))
+        self.assertTrue(e.task is task)
+        self.assertTrue(task.time_completed is not None)
+
+    def test_unpicklable_response(self):
+        task = self.pending_task(1)
+        packed = shardedhttpreactor._pack_result(
+                shardedhttpreactor._MSG_FULFILLED, 1, task,
+                response=threading.Lock())
+        self.assertEqual(set(self.payload(packed)), PAYLOAD_KEYS)
+        self.settle(packed)
+        self.assertTrue(task.promise.is_rejected)
+        self.assertTrue(isinstance(task.promise.value, IOUHTTPTransportError))
+        self.assertTrue(task.promise.value.underlying_exception is None)
+
+    def test_unpicklable_underlying_exception(self):
+        task = self.pending_task(1)
+        e = ValueError("bad")
+        e.lock = threading.Lock()
+        self.settle(shardedhttpreactor._pack_result(
+                shardedhttpreactor._MSG_REJECTED, 1, task, message="failed",
+                status_code=404, underlying_exception=e))
+        self.assertTrue(task.promise.is_rejected)
+        self.assertEqual(str(task.promise.value), "failed")
+        self.assertEqual(task.promise.value.status_code, 404)
+
+    def test_unpicklable_result(self):
+        task = self.pending_task(1)
+        self.settle(shardedhttpreactor._pack_result(
+                shardedhttpreactor._MSG_REJECTED, 1, task, message="failed",
+                underlying_exception=TwoArgError("a", "b")))
+        self.assertTrue(task.promise.is_rejected)
+        self.assertTrue(isinstance(task.promise.value, IOUHTTPTransportError))
+        self.assertFalse(self.reactor._pending)
+
+    def test_malformed_payload_rejects(self):
+        task = self.pending_task(1)
+        self.reactor._settle_task(shardedhttpreactor._MSG_REJECTED, 1,
+                (None, None), {})
+        self.assertTrue(task.promise.is_rejected)
+        self.assertTrue(isinstance(task.promise.value, IOUHTTPTransportError))
+
+
+class LifecycleTest(unittest.TestCase):
+    def setUp(self):
+        self.server = EchoServer(("127.0.0.1", 0), EchoHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/"%self.server.server_address[1]
+        self.reactor = IOUShardedHTTPReactor(2)
+
+    def tearDown(self):
+        self.reactor.stop(blocking=True, timeout=WAIT_TIMEOUT)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_headers(self):
+        self.reactor.update_default_headers({"X-Test": "before"})
+        self.reactor.start()
+        promise = self.reactor.submit_task(IOUHTTPReactorTask(self.url))
+        self.assertEqual(wait(promise).content, "before")
+
+        self.reactor.update_default_headers({"X-Test": "after"})
+        promise = self.reactor.submit_task(IOUHTTPReactorTask(self.url))
+        self.assertEqual(wait(promise).content, "after")
+
+    def test_unpicklable_task(self):
+        task = IOUHTTPReactorTask(self.url)
+        task.request_data = (chunk for chunk in ["a", "b"])
+        promise = self.reactor.submit_task(task)
+        self.assertTrue(promise.is_rejected)
+        self.assertTrue(isinstance(promise.value, IOUHTTPTransportError))
+        self.assertFalse(self.reactor._pending)
+
+    def test_unpicklable_result(self):
+        self.reactor.start()
+        promise = self.reactor.submit_task(RaisingTask(self.url))
+        self.assertTrue(isinstance(wait(promise), IOUHTTPTransportError))
+
+        # the collector keeps going after the bad result
+        promise = self.reactor.submit_task(IOUHTTPReactorTask(self.url))
+        self.assertTrue(wait(promise).ok)
+        self.reactor.stop(blocking=True, timeout=WAIT_TIMEOUT)
+        self.assertTrue(self.reactor._did_stop.is_set())
+
+    def test_task_subclass(self):
+        self.reactor.start()
+        promise = self.reactor.submit_task(SlowTask(self.url))
+        self.assertTrue(wait(promise).ok)
+
+    def test_submit_before_start(self):
+        promise = self.reactor.submit_task(IOUHTTPReactorTask(self.url))
+        time.sleep(0.1)
+        self.assertFalse(promise.is_settled)
+        self.reactor.start()
+        self.assertTrue(wait(promise).ok)
+
+    def test_stop_rejects_outstanding_tasks(self):
+        self.reactor.start()
+        promises = [self.reactor.submit_task(SlowTask(self.url))
+                for i in range(5)]
+        time.sleep(0.1)
+        self.reactor.stop(blocking=True, timeout=WAIT_TIMEOUT)
+        for promise in promises:
+            value = wait(promise)
+            if promise.is_rejected:
+                self.assertTrue(isinstance(value, IOUHTTPTransportError))
+            else:
+                self.assertTrue(isinstance(value, requests.Response))
+        self.assertTrue([p for p in promises if p.is_rejected])
+        self.assertFalse(self.reactor._pending)
+
+    def test_restart(self):
+        self.reactor.start()
+        self.reactor.stop()
+        self.reactor.start()
+        self.assertTrue(self.reactor.is_running)
+        promise = self.reactor.submit_task(IOUHTTPReactorTask(self.url))
+        self.assertTrue(wait(promise).ok)
+
+    def test_dead_shard_is_replaced(self):
+        self.reactor.start()
+        promise = self.reactor.submit_task(ExitTask(self.url))
+        self.assertTrue(isinstance(wait(promise), IOUHTTPTransportError))
+
+        # the same host is served by the replacement shard process
+        promise = self.reactor.submit_task(IOUHTTPReactorTask(self.url))
+        self.assertTrue(wait(promise).ok)
+        self.assertFalse(self.reactor._pending)
+
+    def test_submit_after_every_shard_died(self):
+        self.reactor = IOUShardedHTTPReactor(1)
+        self.reactor.start()
+        promise = self.reactor.submit_task(ExitTask(self.url))
+        self.assertTrue(isinstance(wait(promise), IOUHTTPTransportError))
+
+        promise = self.reactor.submit_task(IOUHTTPReactorTask(self.url))
+        self.assertTrue(wait(promise).ok)
+
+if __name__ == "__main__":
+    unittest.main()